@@ -0,0 +1,350 @@
+"""
+Offline bulk analysis of meal photos.
+
+Usage:
+    python -m api.batch INPUT [-o results.jsonl] [options]
+
+INPUT is either a directory of images (searched recursively) or a CSV/JSONL
+manifest with a "path" column/key and an optional "id". Any other manifest
+fields are copied to the output record under "meta".
+
+Results are appended to the output file as one JSON object per line. Images
+whose id already has a successful record for the same --mode in the output are
+skipped, so an interrupted run picks up where it stopped when started again
+with the same arguments.
+"""
+import argparse
+import asyncio
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import orjson
+from tqdm import tqdm
+
+from api.imaging import DEFAULT_MAX_SIDE, load_and_prepare
+from api.main import (
+    ESTIMATION_MODE,
+    ESTIMATION_MODES,
+    VISION_MAX_BATCH_SIZE,
+    detect_food_labels_batch,
+    filter_candidates,
+    get_consolidated_macros,
+    get_macros_from_openai,
+    get_vision_client,
+    is_model_estimate,
+)
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif", ".tif", ".tiff"}
+
+
+class RateLimiter:
+    """Space out calls so that at most `rate` of them start per second."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate and rate > 0 else 0.0
+        self._next_slot = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        if not self.interval:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            if self._next_slot > now:
+                await asyncio.sleep(self._next_slot - now)
+                now = self._next_slot
+            self._next_slot = now + self.interval
+
+
+def load_items(source):
+    """
+    Build the list of images to process.
+
+    Args:
+        source: A directory of images or a .csv/.jsonl manifest
+
+    Returns:
+        A list of dicts with "id", "path" and optionally "meta"
+    """
+    if os.path.isdir(source):
+        items = []
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for name in sorted(files):
+                if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                    path = os.path.join(root, name)
+                    items.append({"id": os.path.relpath(path, source).replace(os.sep, "/"), "path": path})
+        return items
+
+    ext = os.path.splitext(source)[1].lower()
+    if ext == ".csv":
+        with open(source, newline="", encoding="utf-8-sig") as f:
+            rows = list(csv.DictReader(f))
+    elif ext in (".jsonl", ".ndjson"):
+        with open(source, encoding="utf-8") as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+    else:
+        raise ValueError(f"Unsupported input {source!r}: expected a directory, .csv or .jsonl manifest")
+
+    base_dir = os.path.dirname(os.path.abspath(source))
+    items = []
+    for line_no, row in enumerate(rows, start=1):
+        path = row.get("path")
+        if not path:
+            raise ValueError(f"Manifest entry {line_no} has no 'path'")
+        item = {
+            "id": str(row.get("id") or path),
+            "path": path if os.path.isabs(path) else os.path.join(base_dir, path),
+        }
+        meta = {k: v for k, v in row.items() if k not in ("id", "path")}
+        if meta:
+            item["meta"] = meta
+        items.append(item)
+    return items
+
+
+def load_checkpoint(output_path, mode):
+    """
+    Return the ids that already have a successful record for `mode` in the output file.
+
+    A trailing partial line left by an interrupted run is truncated so new
+    records can be appended safely.
+    """
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, "rb+") as f:
+        data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end != len(data):
+            f.truncate(end)
+    for line in data[:end].splitlines():
+        try:
+            record = orjson.loads(line)
+        except ValueError:
+            continue
+        if record.get("success") and record.get("mode") == mode:
+            done.add(record["id"])
+    return done
+
+
+async def run_batch(items, out, args):
+    """
+    Decode, annotate and estimate macros for every item, writing one JSON line per image.
+
+    Returns:
+        A dict with "succeeded" and "failed" counts
+    """
+    loop = asyncio.get_running_loop()
+    client = get_vision_client()
+    if not client:
+        raise RuntimeError("Vision API is not properly configured. Check your Google Cloud credentials.")
+
+    vision_limiter = RateLimiter(args.vision_rps)
+    openai_limiter = RateLimiter(args.openai_rps)
+    openai_slots = asyncio.Semaphore(args.concurrency)
+    # Caps the number of decoded images waiting on the model so memory stays bounded
+    pending_estimates = asyncio.Semaphore(args.concurrency * 4)
+    decoded = asyncio.Queue(maxsize=args.vision_batch_size * 2)
+    counts = {"succeeded": 0, "failed": 0}
+    progress = tqdm(total=len(items), unit="img", dynamic_ncols=True)
+
+    def write_record(record):
+        out.write(orjson.dumps(record).decode() + "\n")
+        out.flush()
+        counts["succeeded" if record["success"] else "failed"] += 1
+        progress.update(1)
+        progress.set_postfix(counts, refresh=False)
+
+    def failure(item, error):
+        record = {"id": item["id"], "path": item["path"], "success": False, "error": error}
+        if "meta" in item:
+            record["meta"] = item["meta"]
+        return record
+
+    async def decode_alone(item):
+        # In a process of its own, so an image that kills its worker only fails itself
+        solo = ProcessPoolExecutor(max_workers=1)
+        try:
+            return await loop.run_in_executor(solo, load_and_prepare, item["path"], args.max_side)
+        finally:
+            solo.shutdown(wait=False)
+
+    async def decode_all():
+        in_flight = asyncio.Semaphore(args.workers * 2)
+        pool = ProcessPoolExecutor(max_workers=args.workers)
+
+        async def decode(item):
+            nonlocal pool
+            async with in_flight:
+                current = pool
+                try:
+                    try:
+                        prepared = await loop.run_in_executor(current, load_and_prepare, item["path"], args.max_side)
+                    except BrokenProcessPool:
+                        # A worker died (out of memory, decoder crash) and took
+                        # every image queued on the pool with it: replace the pool
+                        # and retry each of those images once
+                        if pool is current:
+                            current.shutdown(wait=False, cancel_futures=True)
+                            pool = ProcessPoolExecutor(max_workers=args.workers)
+                        prepared = await decode_alone(item)
+                except Exception as e:
+                    write_record(failure(item, f"Could not read image: {e}"))
+                    return
+            await decoded.put((item, prepared))
+
+        try:
+            await asyncio.gather(*(decode(item) for item in items))
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+        await decoded.put(None)
+
+    async def estimate(item, prepared, detection):
+        try:
+            if isinstance(detection, Exception):
+                write_record(failure(item, str(detection)))
+                return
+            food_labels, candidates = detection
+
+            async def estimate_label(label):
+                async with openai_slots:
+                    await openai_limiter.wait()
+                    return await get_macros_from_openai(prepared["image"], label)
+
+            if args.mode == "consolidated":
+                async with openai_slots:
+                    await openai_limiter.wait()
+                    results = await get_consolidated_macros(prepared["image"], food_labels, candidates)
+            else:
+                estimates = await asyncio.gather(*(estimate_label(label) for label in food_labels))
+                results = [{"label": label, "macros": macros} for label, macros in zip(food_labels, estimates) if macros]
+            # Fallback defaults are not real estimates: record them as failures
+            # so the image is tried again when the run is resumed
+            estimated = bool(results) and all(is_model_estimate(result["macros"]) for result in results)
+            record = {
+                "id": item["id"],
+                "path": item["path"],
+                "sha256": prepared["sha256"],
+                "width": prepared["width"],
+                "height": prepared["height"],
+                "phash": prepared["phash"],
+                "success": estimated,
+                "mode": args.mode,
+                "labels": food_labels,
+                "results": results,
+                "candidates": filter_candidates(candidates),
+            }
+            if not results:
+                record["error"] = "No nutritional estimate returned"
+            elif not estimated:
+                record["error"] = "Fallback estimate used for " + ", ".join(
+                    result["label"] for result in results if not is_model_estimate(result["macros"])
+                )
+            if "meta" in item:
+                record["meta"] = item["meta"]
+            write_record(record)
+        except Exception as e:
+            write_record(failure(item, f"Error analyzing food: {e}"))
+        finally:
+            pending_estimates.release()
+
+    async def annotate_all():
+        tasks = set()
+        finished = False
+        while not finished:
+            entry = await decoded.get()
+            if entry is None:
+                break
+            batch = [entry]
+            # Give decoding a moment to fill the batch before sending it
+            deadline = loop.time() + args.vision_batch_wait
+            while len(batch) < args.vision_batch_size:
+                try:
+                    entry = await asyncio.wait_for(decoded.get(), max(deadline - loop.time(), 0))
+                except asyncio.TimeoutError:
+                    break
+                if entry is None:
+                    finished = True
+                    break
+                batch.append(entry)
+
+            await vision_limiter.wait()
+            try:
+                detections = await loop.run_in_executor(
+                    None, detect_food_labels_batch, [prepared["image"] for _, prepared in batch], client
+                )
+            except Exception as e:
+                detections = [e] * len(batch)
+
+            for (item, prepared), detection in zip(batch, detections):
+                await pending_estimates.acquire()
+                task = asyncio.create_task(estimate(item, prepared, detection))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        await asyncio.gather(*list(tasks))
+
+    try:
+        await asyncio.gather(decode_all(), annotate_all())
+    finally:
+        progress.close()
+    return counts
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="python -m api.batch",
+        description="Estimate macros for a directory or manifest of meal photos.",
+    )
+    parser.add_argument("input", help="Directory of images, or a .csv/.jsonl manifest with a 'path' field")
+    parser.add_argument("-o", "--output", default="results.jsonl", help="JSONL file results are appended to (default: %(default)s)")
+    parser.add_argument("--restart", action="store_true", help="Ignore existing results and start over")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Processes used to decode and resize images (default: %(default)s)")
+    parser.add_argument("--max-side", type=int, default=DEFAULT_MAX_SIDE, help="Longest image edge sent to the models, in pixels (default: %(default)s)")
+    parser.add_argument("--vision-batch-size", type=int, default=VISION_MAX_BATCH_SIZE, help=f"Images per Vision request, at most {VISION_MAX_BATCH_SIZE} (default: %(default)s)")
+    parser.add_argument("--vision-batch-wait", type=float, default=0.5, help="Seconds to wait for a Vision batch to fill (default: %(default)s)")
+    parser.add_argument("--vision-rps", type=float, default=5.0, help="Maximum Vision requests per second, 0 for no limit (default: %(default)s)")
+    parser.add_argument("--openai-rps", type=float, default=5.0, help="Maximum OpenAI requests per second, 0 for no limit (default: %(default)s)")
+    parser.add_argument("--mode", choices=ESTIMATION_MODES, default=ESTIMATION_MODE, help="One OpenAI call per image or one per detected label (default: %(default)s)")
+    parser.add_argument("--concurrency", type=int, default=8, help="Maximum OpenAI requests in flight (default: %(default)s)")
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if not 1 <= args.vision_batch_size <= VISION_MAX_BATCH_SIZE:
+        parser.error(f"--vision-batch-size must be between 1 and {VISION_MAX_BATCH_SIZE}")
+    if args.workers < 1 or args.concurrency < 1:
+        parser.error("--workers and --concurrency must be at least 1")
+
+    try:
+        items = load_items(args.input)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    if args.restart and os.path.exists(args.output):
+        os.remove(args.output)
+    done = load_checkpoint(args.output, args.mode)
+    todo = [item for item in items if item["id"] not in done]
+    print(f"{len(items)} images found, {len(items) - len(todo)} already done, {len(todo)} to process")
+    if not todo:
+        return 0
+
+    start_time = time.time()
+    with open(args.output, "a", encoding="utf-8") as out:
+        counts = asyncio.run(run_batch(todo, out, args))
+    elapsed = time.time() - start_time
+    processed = counts["succeeded"] + counts["failed"]
+    print(f"Processed {processed} images in {elapsed:.1f}s ({processed / elapsed:.2f} img/s): "
+          f"{counts['succeeded']} succeeded, {counts['failed']} failed")
+    return 0 if not counts["failed"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
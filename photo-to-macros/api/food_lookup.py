@@ -1,5 +1,6 @@
 import re
 from .usda_lookup import get_usda_macros
+from .nutrients import scale_macros
 
 def get_macros_from_label(label):
     """
@@ -27,9 +28,7 @@ def get_macros_from_label(label):
         # Scale macros by quantity if needed
         usda_macros = usda_macros.copy()
         if quantity > 1:
-            for k in ['calories', 'protein', 'carbs', 'fat']:
-                if k in usda_macros and isinstance(usda_macros[k], (int, float)):
-                    usda_macros[k] *= quantity
+            usda_macros = scale_macros(usda_macros, quantity)
         usda_macros['quantity'] = quantity
         usda_macros['base_item'] = base_label
         return usda_macros
@@ -130,10 +129,7 @@ def get_macros_from_label(label):
     # If we found macros and have a quantity > 1, multiply the values
     if base_macros and quantity > 1:
         return {
-            "calories": base_macros.get("calories", 0) * quantity,
-            "protein": base_macros.get("protein", 0) * quantity,
-            "carbs": base_macros.get("carbs", 0) * quantity,
-            "fat": base_macros.get("fat", 0) * quantity,
+            **scale_macros(base_macros, quantity),
             "quantity": quantity,
             "base_item": lookup_label
         }
@@ -0,0 +1,80 @@
+import hashlib
+import io
+
+from PIL import Image, ImageOps
+
+# Longest edge, in pixels, that images are downscaled to before analysis.
+# Both Vision and OpenAI work fine at this size and it keeps uploads small.
+DEFAULT_MAX_SIDE = 1024
+JPEG_QUALITY = 85
+
+# Larger images are rejected before decoding, so a single huge file can't run a
+# worker out of memory (decoding takes 3 bytes per pixel, more while rotating).
+# 64 MP still covers the largest phone cameras. Pillow itself raises
+# DecompressionBombError from twice this size.
+MAX_IMAGE_PIXELS = 64_000_000
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+
+def content_hash(image_bytes):
+    """Return the SHA-256 hex digest of the raw image bytes."""
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def perceptual_hash(img, hash_size=8):
+    """
+    Difference hash (dHash) of a PIL image as a hex string.
+
+    Visually similar images (re-encoded, resized, slightly recompressed) get
+    hashes that differ in only a few bits, unlike content_hash.
+    """
+    small = img.convert("L").resize((hash_size + 1, hash_size))
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return f"{bits:0{hash_size * hash_size // 4}x}"
+
+
+def prepare_image(image_bytes, max_side=DEFAULT_MAX_SIDE):
+    """
+    Decode an image, apply its EXIF orientation and downscale it.
+
+    Args:
+        image_bytes: The original image data in bytes
+        max_side: Longest edge of the output image in pixels
+
+    Returns:
+        A dict with the re-encoded RGB JPEG ("image"), its "width" and
+        "height", and the perceptual hash of the picture ("phash")
+    """
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        if img.width * img.height > MAX_IMAGE_PIXELS:
+            raise ValueError(f"Image is {img.width}x{img.height}, more than {MAX_IMAGE_PIXELS} pixels")
+        img = ImageOps.exif_transpose(img)
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        img.thumbnail((max_side, max_side))
+        out = io.BytesIO()
+        img.save(out, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+        return {"image": out.getvalue(), "width": img.width, "height": img.height, "phash": perceptual_hash(img)}
+
+
+def load_and_prepare(path, max_side=DEFAULT_MAX_SIDE):
+    """
+    Read an image file, hash it and prepare it for analysis.
+
+    Kept at module level (and free of API imports) so it can run in worker
+    processes of a ProcessPoolExecutor.
+
+    Returns:
+        The prepare_image dict plus the content hash of the original file ("sha256")
+    """
+    with open(path, "rb") as f:
+        raw = f.read()
+    prepared = prepare_image(raw, max_side)
+    prepared["sha256"] = content_hash(raw)
+    return prepared
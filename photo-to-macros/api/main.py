@@ -1,16 +1,29 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import FastAPI, File, UploadFile, HTTPException, Header, Response
 from fastapi.middleware.cors import CORSMiddleware
-import base64
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, PlainTextResponse
+try:
+    from brotli_asgi import BrotliMiddleware
+except ImportError:
+    BrotliMiddleware = None
 import sys
 import os
 import io
-from typing import List
+from typing import List, Optional
+from collections import OrderedDict
 from google.cloud import vision
 from google.oauth2 import service_account
 import json
+import orjson
+from pydantic import ValidationError
 from dotenv import load_dotenv
 from api.food_lookup import get_macros_from_label
-from api.prompts import gpt_blurb
+from api.imaging import content_hash
+from api.nutrients import NutrientVector, total_macros
+from api.profiler import ProfilerBusy, profile
+from api.prompts import MAX_PROMPT_HINTS, consolidated_prompt, gpt_blurb, macro_prompt
+from api.schemas import MACRO_RESPONSE_FORMAT, MacroEstimate
+from api.workers import CPUWorkerPool
 import numpy as np
 from PIL import Image
 import time
@@ -19,7 +32,11 @@ import random
 import requests
 from io import BytesIO
 import hashlib
-from functools import lru_cache
+import hmac
+import re
+from functools import lru_cache, partial
+from contextlib import asynccontextmanager
+import asyncio
 
 # Load environment variables
 dotenv_path = os.path.join(os.path.dirname(__file__), '..', '.env')
@@ -32,14 +49,42 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 # Simple response cache
 openai_response_cache = {}
 
-app = FastAPI()
+# Bump whenever a change to detection, prompts or parsing changes the results,
+# so clients holding an ETag from an older pipeline get fresh data
+PIPELINE_VERSION = "5"
+
+# Complete analysis results by image content hash, least recently used first
+RESULT_CACHE_SIZE = 1024
+analysis_results = OrderedDict()
+
+# Process pool for CPU-heavy work on uploads (decoding, resizing, hashing, base64)
+cpu_pool = CPUWorkerPool(int(os.environ["CPU_WORKERS"]) if os.environ.get("CPU_WORKERS") else None)
+
+@asynccontextmanager
+async def lifespan(app):
+    # Wait for the workers to come up so the first uploads don't pay for it
+    await asyncio.gather(*map(asyncio.wrap_future, cpu_pool.start()))
+    try:
+        yield
+    finally:
+        cpu_pool.shutdown()
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"], allow_credentials=True,
     allow_methods=["*"], allow_headers=["*"],
+    expose_headers=["ETag"],
 )
 
+# Compress larger responses (batch and streaming ones in particular), with
+# Brotli when brotli-asgi is installed and gzip otherwise
+if BrotliMiddleware is not None:
+    app.add_middleware(BrotliMiddleware, minimum_size=1024, gzip_fallback=True)
+else:
+    app.add_middleware(GZipMiddleware, minimum_size=1024)
+
 # Helper function to initialize Google Cloud Vision client
 def get_vision_client():
     """
@@ -145,15 +190,52 @@ def filter_candidates(candidates):
         if c["label"] not in GENERIC_LABELS and (len(c["label"].split()) > 1 or c["label"] in ["pad thai", "shrimp pad thai", "spaghetti", "ramen", "cheeseburger", "hamburger", "pizza", "taco", "burrito", "fried rice", "chicken curry", "beef stew", "caesar salad", "egg fried rice"])
     ]
 
+# Words that say nothing about which food a component is
+LABEL_STOPWORDS = {"a", "an", "and", "the", "of", "with", "on", "in", "side", "small", "large", "portion", "piece", "slice", "serving"}
+
+def label_tokens(text):
+    """Lowercase content words of a food name, with simple plurals folded (tacos -> taco)."""
+    tokens = set()
+    for word in re.findall(r"[a-z]+", text.lower()):
+        if word in LABEL_STOPWORDS:
+            continue
+        if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        tokens.add(word)
+    return tokens
+
+def match_label(component_name, food_labels):
+    """
+    Pick the food label a model component belongs to by word overlap.
+    
+    Ties go to the earlier label, and components that share no words with any
+    label are assigned to the first (main) label.
+    """
+    name_tokens = label_tokens(component_name)
+    best_label, best_score = food_labels[0], 0.0
+    for label in food_labels:
+        tokens = label_tokens(label)
+        if not tokens:
+            continue
+        score = len(name_tokens & tokens) / len(tokens)
+        if score > best_score:
+            best_label, best_score = label, score
+    return best_label
+
 # Detect food labels in image
-def detect_food_labels(image_bytes):
+def detect_food_labels(image_bytes, client=None):
     """
     Detect food items in an image using Google Cloud Vision API.
     
+    Args:
+        image_bytes: The image data in bytes
+        client: An existing Vision client to reuse (a new one is created if omitted)
+    
     Returns:
         A tuple: (detailed_food_labels, candidates) where candidates is a list of dicts with label and confidence
     """
-    client = get_vision_client()
+    if client is None:
+        client = get_vision_client()
     if not client:
         print("Failed to initialize Vision client. Cannot detect food.")
         raise Exception("Vision API is not properly configured. Check your Google Cloud credentials.")
@@ -161,100 +243,146 @@ def detect_food_labels(image_bytes):
         image = vision.Image(content=image_bytes)
         label_response = client.label_detection(image=image, max_results=20)
         object_response = client.object_localization(image=image, max_results=10)
-        labels = label_response.label_annotations
-        objects = object_response.localized_object_annotations
-        object_labels = [obj.name.lower() for obj in objects if obj.score > 0.6]
-        food_counts = {}
-        for obj in objects:
-            if obj.score > 0.6:
-                name = obj.name.lower()
-                if name in food_counts:
-                    food_counts[name] += 1
-                else:
-                    food_counts[name] = 1
-        food_keywords = ["food", "dish", "cuisine", "meal", "fruit", "vegetable", "meat", "bread", "dessert", "breakfast", "lunch", "dinner", "snack", "beverage", "drink", "sandwich", "salad", "pasta", "rice", "potato", "burger", "pizza", "cake", "cookie", "taco"]
-        detailed_food_labels = []
-        food_labels = []
-        food_labels.extend(object_labels)
+        return parse_food_annotations(label_response.label_annotations, object_response.localized_object_annotations)
+    except Exception as e:
+        print(f"Error in vision API: {e}")
+        raise Exception(f"Error processing image with Vision API: {e}")
+
+# Vision accepts at most 16 images per batch_annotate_images request
+VISION_MAX_BATCH_SIZE = 16
+
+def detect_food_labels_batch(images, client=None):
+    """
+    Detect food items in several images with a single Vision API request.
+    
+    Args:
+        images: A list of image data in bytes (at most VISION_MAX_BATCH_SIZE)
+        client: An existing Vision client to reuse (a new one is created if omitted)
+    
+    Returns:
+        A list with one entry per image, either a (detailed_food_labels, candidates)
+        tuple or the Exception raised for that image
+    """
+    if len(images) > VISION_MAX_BATCH_SIZE:
+        raise ValueError(f"Vision batches are limited to {VISION_MAX_BATCH_SIZE} images, got {len(images)}")
+    if client is None:
+        client = get_vision_client()
+    if not client:
+        raise Exception("Vision API is not properly configured. Check your Google Cloud credentials.")
+    features = [
+        vision.Feature(type_=vision.Feature.Type.LABEL_DETECTION, max_results=20),
+        vision.Feature(type_=vision.Feature.Type.OBJECT_LOCALIZATION, max_results=10),
+    ]
+    annotate_requests = [
+        vision.AnnotateImageRequest(image=vision.Image(content=image_bytes), features=features)
+        for image_bytes in images
+    ]
+    response = client.batch_annotate_images(requests=annotate_requests)
+    results = []
+    for image_response in response.responses:
+        if image_response.error.message:
+            results.append(Exception(f"Error processing image with Vision API: {image_response.error.message}"))
+            continue
+        try:
+            results.append(parse_food_annotations(image_response.label_annotations, image_response.localized_object_annotations))
+        except Exception as e:
+            results.append(Exception(f"Error processing image with Vision API: {e}"))
+    return results
+
+def parse_food_annotations(labels, objects):
+    """
+    Turn Vision label and object annotations into food labels.
+    
+    Returns:
+        A tuple: (detailed_food_labels, candidates) where candidates is a list of dicts with label and confidence
+    """
+    object_labels = [obj.name.lower() for obj in objects if obj.score > 0.6]
+    food_counts = {}
+    for obj in objects:
+        if obj.score > 0.6:
+            name = obj.name.lower()
+            if name in food_counts:
+                food_counts[name] += 1
+            else:
+                food_counts[name] = 1
+    food_keywords = ["food", "dish", "cuisine", "meal", "fruit", "vegetable", "meat", "bread", "dessert", "breakfast", "lunch", "dinner", "snack", "beverage", "drink", "sandwich", "salad", "pasta", "rice", "potato", "burger", "pizza", "cake", "cookie", "taco"]
+    detailed_food_labels = []
+    food_labels = []
+    food_labels.extend(object_labels)
+    for label in labels:
+        if label.score > 0.7 and label.description.lower() not in food_labels:
+            food_labels.append(label.description.lower())
+    if not any(keyword in ' '.join(food_labels).lower() for keyword in food_keywords):
         for label in labels:
-            if label.score > 0.7 and label.description.lower() not in food_labels:
-                food_labels.append(label.description.lower())
-        if not any(keyword in ' '.join(food_labels).lower() for keyword in food_keywords):
-            for label in labels:
-                if any(keyword in label.description.lower() for keyword in food_keywords) and label.score > 0.6:
-                    for sub_label in labels:
-                        if sub_label.score > 0.65 and sub_label.description.lower() not in food_labels:
-                            food_labels.append(sub_label.description.lower())
-        if not food_labels and labels:
-            for label in labels[:3]:
-                food_labels.append(label.description.lower())
-        for label in food_labels:
-            if label in food_counts and food_counts[label] > 1:
-                detailed_label = f"{food_counts[label]} {label}s"
+            if any(keyword in label.description.lower() for keyword in food_keywords) and label.score > 0.6:
+                for sub_label in labels:
+                    if sub_label.score > 0.65 and sub_label.description.lower() not in food_labels:
+                        food_labels.append(sub_label.description.lower())
+    if not food_labels and labels:
+        for label in labels[:3]:
+            food_labels.append(label.description.lower())
+    for label in food_labels:
+        if label in food_counts and food_counts[label] > 1:
+            detailed_label = f"{food_counts[label]} {label}s"
+            detailed_food_labels.append(detailed_label)
+        else:
+            descriptors = []
+            for desc_label in food_labels:
+                if desc_label != label and desc_label not in ["food", "dish", "meal"]:
+                    if (desc_label + " " + label) in " ".join(food_labels) or any(desc_label in l and label in l for l in food_labels):
+                        descriptors.append(desc_label)
+            if descriptors:
+                descriptor_str = " ".join(descriptors[:2])
+                detailed_label = f"{descriptor_str} {label}"
                 detailed_food_labels.append(detailed_label)
             else:
-                descriptors = []
-                for desc_label in food_labels:
-                    if desc_label != label and desc_label not in ["food", "dish", "meal"]:
-                        if (desc_label + " " + label) in " ".join(food_labels) or any(desc_label in l and label in l for l in food_labels):
-                            descriptors.append(desc_label)
-                if descriptors:
-                    descriptor_str = " ".join(descriptors[:2])
-                    detailed_label = f"{descriptor_str} {label}"
-                    detailed_food_labels.append(detailed_label)
-                else:
-                    detailed_food_labels.append(label)
-        if "taco" in food_labels:
-            number_words = ["one", "two", "three", "four", "five", "six", "seven", "eight", "nine"]
-            found_number = None
+                detailed_food_labels.append(label)
+    if "taco" in food_labels:
+        number_words = ["one", "two", "three", "four", "five", "six", "seven", "eight", "nine"]
+        found_number = None
+        for label in food_labels:
+            if label in number_words:
+                found_number = number_words.index(label) + 1
+                break
+        if not found_number:
             for label in food_labels:
-                if label in number_words:
-                    found_number = number_words.index(label) + 1
+                if label.isdigit() and int(label) > 0 and int(label) < 10:
+                    found_number = int(label)
                     break
-            if not found_number:
-                for label in food_labels:
-                    if label.isdigit() and int(label) > 0 and int(label) < 10:
-                        found_number = int(label)
-                        break
-            if found_number:
-                detailed_food_labels = [label.replace("taco", f"{found_number} tacos") if "taco" in label else label for label in detailed_food_labels]
-        if "taco" in " ".join(food_labels).lower() and food_counts.get("taco", 0) > 1:
-            taco_count = food_counts.get("taco", 0)
-            taco_entry_found = False
-            for i, label in enumerate(detailed_food_labels):
-                if "taco" in label.lower():
-                    detailed_food_labels[i] = f"{taco_count} tacos"
-                    taco_entry_found = True
-                    break
-            if not taco_entry_found:
-                detailed_food_labels.append(f"{taco_count} tacos")
-        candidates = []
-        for label in labels:
-            candidates.append({
-                "label": label.description.lower(),
-                "confidence": round(float(label.score) * 100, 1)  # percentage
-            })
-        print(f"Basic food labels: {food_labels}")
-        print(f"Detailed food labels: {detailed_food_labels}")
-        print(f"Candidates: {candidates}")
-        return (detailed_food_labels if detailed_food_labels else ["unidentified food"], candidates)
-    except Exception as e:
-        print(f"Error in vision API: {e}")
-        raise Exception(f"Error processing image with Vision API: {e}")
+        if found_number:
+            detailed_food_labels = [label.replace("taco", f"{found_number} tacos") if "taco" in label else label for label in detailed_food_labels]
+    if "taco" in " ".join(food_labels).lower() and food_counts.get("taco", 0) > 1:
+        taco_count = food_counts.get("taco", 0)
+        taco_entry_found = False
+        for i, label in enumerate(detailed_food_labels):
+            if "taco" in label.lower():
+                detailed_food_labels[i] = f"{taco_count} tacos"
+                taco_entry_found = True
+                break
+        if not taco_entry_found:
+            detailed_food_labels.append(f"{taco_count} tacos")
+    candidates = []
+    for label in labels:
+        candidates.append({
+            "label": label.description.lower(),
+            "confidence": round(float(label.score) * 100, 1)  # percentage
+        })
+    print(f"Basic food labels: {food_labels}")
+    print(f"Detailed food labels: {detailed_food_labels}")
+    print(f"Candidates: {candidates}")
+    return (detailed_food_labels if detailed_food_labels else ["unidentified food"], candidates)
 
 def generate_macro_summary(label, macros):
     """Generate a summary of the macro information."""
     if not macros:
         return f"Could not find nutritional information for {label}."
     
+    nutrients = NutrientVector.from_dict(macros)
     calories = macros.get('calories', 0)
     protein = macros.get('protein', 0)
     carbs = macros.get('carbs', 0)
     fat = macros.get('fat', 0)
     
-    # Calculate calories from macros (for verification)
-    calculated_calories = (protein * 4) + (carbs * 4) + (fat * 9)
-    
     summary = [
         f"Identified food: {label.title()}",
         f"Nutritional information (per 100g):",
@@ -264,18 +392,34 @@ def generate_macro_summary(label, macros):
         f"• Fat: {fat}g",
     ]
     
-    # Add protein percentage of calories
-    if calories > 0:
-        protein_pct = (protein * 4 / calories) * 100
-        carbs_pct = (carbs * 4 / calories) * 100
-        fat_pct = (fat * 9 / calories) * 100
-        
-        summary.append(f"• Protein: {protein_pct:.1f}% of calories")
-        summary.append(f"• Carbs: {carbs_pct:.1f}% of calories")
-        summary.append(f"• Fat: {fat_pct:.1f}% of calories")
+    # Add each macro's percentage of calories
+    shares = nutrients.calorie_shares()
+    if shares:
+        summary.append(f"• Protein: {shares['protein']:.1f}% of calories")
+        summary.append(f"• Carbs: {shares['carbs']:.1f}% of calories")
+        summary.append(f"• Fat: {shares['fat']:.1f}% of calories")
+    
+    # Flag estimates whose calories don't add up (for verification)
+    if not nutrients.is_energy_consistent():
+        summary.append(f"• Note: macros imply about {nutrients.atwater_calories():.0f} kcal")
     
     return "\n".join(summary)
 
+# Rough per-item estimate used when the model gives us nothing usable
+DEFAULT_ESTIMATE = {'calories': 250, 'protein': 15, 'carbs': 25, 'fat': 10}
+
+def fallback_macros(food_label, source):
+    """Build a single-component estimate for food_label from DEFAULT_ESTIMATE."""
+    return {
+        'total': dict(DEFAULT_ESTIMATE),
+        'components': [{'name': food_label, **DEFAULT_ESTIMATE}],
+        'source': source
+    }
+
+def is_model_estimate(macros):
+    """True if macros is an estimate the model actually returned, not a fallback or summary text."""
+    return isinstance(macros, dict) and macros.get('source') == 'openai'
+
 # OpenAI Vision API function
 async def get_macros_from_openai(image_bytes, food_label):
     """
@@ -288,6 +432,26 @@ async def get_macros_from_openai(image_bytes, food_label):
     Returns:
         A dictionary containing macronutrient information
     """
+    return await request_macro_estimate(image_bytes, macro_prompt(food_label), food_label)
+
+# Reply budget for one label's estimate, and what each further item in a
+# reply costs (an item object is about 25-30 tokens)
+MACRO_MAX_TOKENS = 250
+MACRO_TOKENS_PER_ITEM = 30
+
+async def request_macro_estimate(image_bytes, prompt, food_label, max_tokens=MACRO_MAX_TOKENS):
+    """
+    Send the image and a macro prompt to OpenAI and parse the estimate.
+    
+    Args:
+        image_bytes: The image data in bytes
+        prompt: A prompt from api.prompts (the reply format is set by MACRO_RESPONSE_FORMAT)
+        food_label: The label used for logging and for the fallback estimate
+        max_tokens: Reply token limit; a reply cut off by it can't be parsed
+        
+    Returns:
+        A dictionary with total, components and source, or None if OpenAI isn't configured
+    """
     try:
         # Get OpenAI API key from environment
         api_key = os.environ.get("OPENAI_API_KEY")
@@ -295,34 +459,13 @@ async def get_macros_from_openai(image_bytes, food_label):
             print("OpenAI API key not found in environment variables")
             return None
         
-        # Create a cache key based on the image and food label but don't use it
+        # Create a cache key based on the image and prompt but don't use it
         # Just for logging purposes
-        cache_key = hashlib.md5(image_bytes + food_label.encode('utf-8')).hexdigest()
+        cache_key = hashlib.md5(image_bytes + prompt.encode('utf-8')).hexdigest()
         print(f"Processing {food_label} (key: {cache_key[:8]})")
             
-        # Convert image bytes to base64
-        base64_image = base64.b64encode(image_bytes).decode('utf-8')
-        
-        # Create a simpler prompt for faster processing
-        prompt = f"""
-        This image contains {food_label}. 
-        
-        Identify the main food items and for EACH provide:
-        1. Name
-        2. Calories
-        3. Protein (g)
-        4. Carbs (g)
-        5. Fat (g)
-        
-        Return ONLY a valid JSON object in this structure:
-        {{
-          "total": {{"calories": number, "protein": number, "carbs": number, "fat": number}},
-          "components": [
-            {{"name": "food1", "calories": number, "protein": number, "carbs": number, "fat": number}},
-            {{"name": "food2", "calories": number, "protein": number, "carbs": number, "fat": number}}
-          ]
-        }}
-        """
+        # Convert image bytes to base64 (in the worker pool for large images)
+        base64_image = await cpu_pool.b64encode(image_bytes)
         
         # Prepare the API request
         headers = {
@@ -349,132 +492,48 @@ async def get_macros_from_openai(image_bytes, food_label):
                     ]
                 }
             ],
-            "max_tokens": 250,
+            "max_tokens": max_tokens,
             "temperature": 0.3,
-            "response_format": { "type": "json_object" }
+            "response_format": MACRO_RESPONSE_FORMAT
         }
         
-        # Make the API request
+        # Make the API request in a worker thread so concurrent calls don't block the event loop
         try:
-            response = requests.post(
+            loop = asyncio.get_running_loop()
+            response = await loop.run_in_executor(None, partial(
+                requests.post,
                 "https://api.openai.com/v1/chat/completions",
                 headers=headers,
-                json=payload,
+                data=orjson.dumps(payload),
                 timeout=15  # Set a timeout to prevent hanging
-            )
+            ))
             
             # Process the response
             if response.status_code == 200:
-                result = response.json()
-                content = result['choices'][0]['message']['content']
+                result = orjson.loads(response.content)
+                message = result['choices'][0]['message']
+                content = message.get('content')
                 
-                try:
-                    # Since we requested JSON format, we can parse directly
-                    macros = json.loads(content)
-                    
-                    # Handle new component-based format
-                    if 'components' in macros and 'total' in macros:
-                        # Recalculate the total to ensure accuracy
-                        recalculated_total = {
-                            'calories': sum(comp.get('calories', 0) for comp in macros['components']),
-                            'protein': sum(comp.get('protein', 0) for comp in macros['components']),
-                            'carbs': sum(comp.get('carbs', 0) for comp in macros['components']),
-                            'fat': sum(comp.get('fat', 0) for comp in macros['components'])
-                        }
-                        
-                        # Always use our calculated total instead of the one from OpenAI
-                        macros['total'] = recalculated_total
-                        macros['source'] = 'openai'
-                        
-                        # Don't cache the response
-                        return macros
-                    
-                    # Handle single-item format (backward compatibility)
-                    required_fields = ['calories', 'protein', 'carbs', 'fat']
-                    if all(field in macros for field in required_fields):
-                        # Convert to component-based format
-                        total = {
-                            'calories': macros['calories'],
-                            'protein': macros['protein'],
-                            'carbs': macros['carbs'],
-                            'fat': macros['fat']
-                        }
-                        components = [{
-                            'name': food_label,
-                            'calories': macros['calories'],
-                            'protein': macros['protein'],
-                            'carbs': macros['carbs'],
-                            'fat': macros['fat']
-                        }]
-                        macros = {
-                            'total': total,
-                            'components': components,
-                            'source': 'openai'
-                        }
-                        
-                        # Don't cache the response
-                        return macros
-                    
-                    # If we got here, format is unexpected
-                    print(f"Unexpected response format: {macros}")
-                    
-                    # Create a fallback format from whatever we got
-                    fallback_macros = {
-                        'total': {
-                            'calories': 0,
-                            'protein': 0,
-                            'carbs': 0,
-                            'fat': 0
-                        },
-                        'components': [
-                            {
-                                'name': food_label,
-                                'calories': 0,
-                                'protein': 0,
-                                'carbs': 0,
-                                'fat': 0
-                            }
-                        ],
-                        'source': 'openai_fallback'
-                    }
-                    
-                    # Try to extract values from the response
-                    for key, value in macros.items():
-                        if isinstance(value, dict):
-                            if all(k in value for k in ['calories', 'protein', 'carbs', 'fat']):
-                                fallback_macros['total'] = value
-                                fallback_macros['components'][0].update(value)
-                                fallback_macros['components'][0]['name'] = key
-                    
-                    # Don't cache the fallback response
-                    return fallback_macros
+                # The schema fixes the shape of any reply, so only a refusal
+                # or a reply cut off at max_tokens can fail to parse below
+                if message.get('refusal') or not content:
+                    print(f"OpenAI returned no estimate: {message.get('refusal')}")
+                    return fallback_macros(food_label, 'openai_fallback')
                 
-                except Exception as e:
+                try:
+                    # Validate the JSON string directly into the expected schema
+                    estimate = MacroEstimate.model_validate_json(content)
+                except ValidationError as e:
                     print(f"Error parsing OpenAI response: {e}")
                     print(f"Response content: {content}")
-                    
-                    # Create a simple fallback response
-                    fallback_response = {
-                        'total': {
-                            'calories': 250,
-                            'protein': 15,
-                            'carbs': 25,
-                            'fat': 10
-                        },
-                        'components': [
-                            {
-                                'name': food_label,
-                                'calories': 250,
-                                'protein': 15,
-                                'carbs': 25,
-                                'fat': 10
-                            }
-                        ],
-                        'source': 'openai_fallback'
-                    }
-                    
-                    # Don't cache the fallback response
-                    return fallback_response
+                    return fallback_macros(food_label, 'openai_fallback')
+                
+                # Always use our calculated total instead of asking the model for one
+                return {
+                    'total': estimate.total(),
+                    'components': estimate.components(),
+                    'source': 'openai'
+                }
             
             print(f"OpenAI API request failed with status code: {response.status_code}")
             print(f"Response: {response.text}")
@@ -487,59 +546,179 @@ async def get_macros_from_openai(image_bytes, food_label):
             print(f"Error calling OpenAI API: {e}")
         
         # If all else fails, return a generic response
-        generic_response = {
-            'total': {
-                'calories': 250,
-                'protein': 15,
-                'carbs': 25,
-                'fat': 10
-            },
-            'components': [
-                {
-                    'name': food_label,
-                    'calories': 250,
-                    'protein': 15,
-                    'carbs': 25,
-                    'fat': 10
-                }
-            ],
-            'source': 'generic_fallback'
-        }
-        
-        # Don't cache the generic response
-        return generic_response
+        return fallback_macros(food_label, 'generic_fallback')
         
     except Exception as e:
         print(f"Error calling OpenAI API: {e}")
         return None
 
+async def get_consolidated_macros(image_bytes, food_labels, candidates):
+    """
+    Estimate every food in the image with a single OpenAI call.
+    
+    The detected labels and Vision candidates are sent as hints, and the one
+    component list that comes back is split across food_labels on our side.
+    
+    Args:
+        image_bytes: The image data in bytes
+        food_labels: Detailed food labels from detect_food_labels
+        candidates: Vision candidates with label and confidence
+        
+    Returns:
+        A list of {"label", "macros"} results, one per label that got components.
+        A fallback estimate is not split: it comes back as a single result for
+        all the labels, with its fallback source unchanged.
+    """
+    if not food_labels:
+        return []
+    hints = [c for c in candidates if c["label"] not in GENERIC_LABELS]
+    plate_label = ", ".join(food_labels)
+    # The reply lists every item on the plate: leave room for about two items
+    # per label or hint on top of the single-label budget
+    hint_count = min(len(set(food_labels) | {c["label"] for c in hints}), MAX_PROMPT_HINTS)
+    max_tokens = MACRO_MAX_TOKENS + 2 * MACRO_TOKENS_PER_ITEM * hint_count
+    macros = await request_macro_estimate(
+        image_bytes, consolidated_prompt(food_labels, hints), plate_label, max_tokens=max_tokens
+    )
+    if not macros:
+        return []
+    if not is_model_estimate(macros):
+        # The single made-up component stands for the whole plate, not for any one label
+        return [{"label": plate_label, "macros": macros}]
+    
+    # Every item the model listed is kept, repeated names included: two
+    # "Beef taco" entries are two tacos
+    grouped = {label: [] for label in food_labels}
+    for component in macros['components']:
+        grouped[match_label(component['name'], food_labels)].append(component)
+    
+    return [
+        {
+            "label": label,
+            "macros": {'total': total_macros(label_components), 'components': label_components, 'source': macros['source']}
+        }
+        for label, label_components in grouped.items() if label_components
+    ]
+
+# Seconds an /api/analyze-image request may spend before partial results are returned
+MAX_PROCESSING_TIME = 30
+
+# "consolidated" makes one OpenAI call per image; "per_label" makes one per detected label
+ESTIMATION_MODES = ("consolidated", "per_label")
+ESTIMATION_MODE = os.environ.get("MACRO_ESTIMATION_MODE", "consolidated")
+if ESTIMATION_MODE not in ESTIMATION_MODES:
+    print(f"Unknown MACRO_ESTIMATION_MODE {ESTIMATION_MODE!r}, using 'consolidated'")
+    ESTIMATION_MODE = "consolidated"
+
+def resolve_mode(mode):
+    """Validate a requested estimation mode, defaulting to ESTIMATION_MODE."""
+    if mode is None:
+        return ESTIMATION_MODE
+    if mode not in ESTIMATION_MODES:
+        raise HTTPException(status_code=400, detail=f"mode must be one of {', '.join(ESTIMATION_MODES)}")
+    return mode
+
+def cache_result(image_hash, mode, result):
+    """
+    Remember a complete analysis result under its image content hash and mode.
+
+    Only results made entirely of model estimates (see is_model_estimate) belong here.
+    """
+    analysis_results[(image_hash, mode)] = result
+    analysis_results.move_to_end((image_hash, mode))
+    while len(analysis_results) > RESULT_CACHE_SIZE:
+        analysis_results.popitem(last=False)
+
+# Let clients keep a result but revalidate it with If-None-Match
+RESULT_CACHE_CONTROL = "private, no-cache"
+
+def result_etag(image_hash, mode):
+    """
+    ETag for the analysis of an image: its content hash plus the pipeline version and mode.
+
+    The tag is weak because the compression middleware sends the same result
+    as identity, gzip or brotli bodies, and a strong tag must differ per encoding.
+    """
+    return f'W/"{image_hash}-{PIPELINE_VERSION}-{mode}"'
+
+def etag_matches(if_none_match, etag):
+    """Check an If-None-Match header value against an ETag (weak comparison)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return any((tag[2:] if tag.startswith("W/") else tag) == opaque for tag in tags)
+
+def result_headers(image_hash, mode):
+    return {"ETag": result_etag(image_hash, mode), "Cache-Control": RESULT_CACHE_CONTROL}
+
+def result_response(image_hash, mode, result):
+    return ORJSONResponse(result, headers=result_headers(image_hash, mode))
+
+@app.get("/api/results/{image_hash}")
+async def get_result(image_hash: str, mode: Optional[str] = None, if_none_match: Optional[str] = Header(None)):
+    """
+    Look up a previous analysis by the SHA-256 of the image bytes.
+    
+    Clients can hash a photo locally and call this before uploading it; a 404
+    means the image has to be sent to /api/analyze-image.
+    """
+    mode = resolve_mode(mode)
+    key = (image_hash.lower(), mode)
+    result = analysis_results.get(key)
+    if result is None:
+        return ORJSONResponse({"success": False, "error": "No analysis found for this image."}, status_code=404)
+    analysis_results.move_to_end(key)
+    if etag_matches(if_none_match, result_etag(*key)):
+        # A 304 repeats the validator and caching headers of the 200 it stands for
+        return Response(status_code=304, headers=result_headers(*key))
+    return result_response(*key, result)
+
 @app.post("/api/analyze-image")
-async def analyze_image(file: UploadFile = File(...)):
+async def analyze_image(file: UploadFile = File(...), mode: Optional[str] = None):
+    start_time = time.time()
+    max_processing_time = MAX_PROCESSING_TIME
+    mode = resolve_mode(mode)
     try:
         image_bytes = await file.read()
+        loop = asyncio.get_running_loop()
+        # hashlib releases the GIL on large inputs, so a thread is enough here
+        image_hash = await loop.run_in_executor(None, content_hash, image_bytes)
+        if (image_hash, mode) in analysis_results:
+            print(f"Returning cached analysis for {image_hash[:8]}")
+            return result_response(image_hash, mode, analysis_results[(image_hash, mode)])
         try:
-            food_labels, candidates = detect_food_labels(image_bytes)
+            # Decode and downscale off the event loop; both models get the smaller image
+            prepared = await cpu_pool.prepare_image(image_bytes)
+            image_bytes = prepared["image"]
+            food_labels, candidates = await loop.run_in_executor(None, detect_food_labels, image_bytes)
             macro_results = []
             
-            for label in food_labels:
-                # Check if we're close to timeout
-                if time.time() - start_time > max_processing_time * 0.7:
-                    # If we have at least one result, return what we have
-                    if macro_results:
-                        print(f"Returning partial results due to timeout ({len(macro_results)} of {len(food_labels)} processed)")
-                        return {"success": True, "results": macro_results}
-                    else:
-                        return {"success": False, "error": "Analysis took too long. Please try again with a simpler image."}
+            if mode == "consolidated":
+                # One call for the whole image, split across the labels afterwards
+                macro_results = await get_consolidated_macros(image_bytes, food_labels, candidates)
+            else:
+                for label in food_labels:
+                    # Check if we're close to timeout
+                    if time.time() - start_time > max_processing_time * 0.7:
+                        # If we have at least one result, return what we have
+                        if macro_results:
+                            print(f"Returning partial results due to timeout ({len(macro_results)} of {len(food_labels)} processed)")
+                            return {"success": True, "results": macro_results}
+                        else:
+                            return {"success": False, "error": "Analysis took too long. Please try again with a simpler image."}
                 
-                # First try to get macros from OpenAI
-                openai_macros = await get_macros_from_openai(image_bytes, label)
+                    # First try to get macros from OpenAI
+                    openai_macros = await get_macros_from_openai(image_bytes, label)
                 
-                if openai_macros:
-                    # Use OpenAI results
-                    macro_results.append({
-                        "label": label,
-                        "macros": macros
-                    })
+                    if openai_macros:
+                        # Use OpenAI results
+                        macro_results.append({
+                            "label": label,
+                            "macros": openai_macros
+                        })
             if not macro_results and food_labels:
                 gpt_macros = generate_macro_summary(food_labels[0], None)
                 macro_results.append({
@@ -548,7 +727,14 @@ async def analyze_image(file: UploadFile = File(...)):
                     "source": "ai_estimated"
                 })
             filtered_candidates = filter_candidates(candidates)
-            return {"success": True, "results": macro_results, "candidates": filtered_candidates}
+            result = {"success": True, "image_hash": image_hash, "image_phash": prepared["phash"], "mode": mode, "results": macro_results, "candidates": filtered_candidates}
+            # Fallback defaults and the summary text are not the analysis of
+            # this image: keep them out of the cache and don't tag them with an
+            # ETag, so the next upload of the same image is estimated again
+            if not macro_results or not all(is_model_estimate(r["macros"]) for r in macro_results):
+                return result
+            cache_result(image_hash, mode, result)
+            return result_response(image_hash, mode, result)
         except Exception as e:
             error_message = str(e)
             if "credentials" in error_message.lower():
@@ -558,6 +744,11 @@ async def analyze_image(file: UploadFile = File(...)):
     except Exception as e:
         return {"success": False, "error": f"Error processing image: {str(e)}"}
 
+@app.get("/api/workers/stats")
+async def worker_stats():
+    """Size, queue depth and per-stage task timings of the CPU worker pool."""
+    return cpu_pool.stats()
+
 @app.post("/test-food-detection")
 async def test_food_detection(file: UploadFile = File(...)):
     """
@@ -572,12 +763,62 @@ async def test_food_detection(file: UploadFile = File(...)):
         raise HTTPException(status_code=500, detail=f"Error detecting food: {str(e)}")
 
 @app.post("/analyze")
-async def analyze_endpoint(file: UploadFile = File(...)):
+async def analyze_endpoint(file: UploadFile = File(...), mode: Optional[str] = None):
     """
     Endpoint for the frontend to call - routes to the main analyze_image function.
     This matches the endpoint the frontend is expecting.
     """
-    return await analyze_image(file)
+    return await analyze_image(file, mode)
+
+# The profiler endpoint is only registered when PROFILER_ENABLED is set, is
+# never listed in /openapi.json or /docs, and only answers requests carrying
+# the ADMIN_TOKEN in an X-Admin-Token header
+PROFILER_ENABLED = os.environ.get("PROFILER_ENABLED", "").lower() in ("1", "true", "yes")
+MAX_PROFILE_SECONDS = 60
+
+async def profile_worker(
+    seconds: float = 10,
+    interval_ms: float = 10,
+    format: str = "collapsed",
+    x_admin_token: Optional[str] = Header(None),
+):
+    """
+    Sample the stacks of this worker for `seconds` while it keeps serving traffic.
+    
+    Returns a flamegraph-compatible collapsed-stack file by default, with the
+    event-loop lag summary in X-Loop-Lag-* headers. format=json returns the
+    stacks together with the lag summary and the time the loop was blocked
+    per call site.
+    """
+    admin_token = os.environ.get("ADMIN_TOKEN")
+    if not admin_token or not hmac.compare_digest(x_admin_token or "", admin_token):
+        raise HTTPException(status_code=403, detail="Admin token required")
+    if not 0 < seconds <= MAX_PROFILE_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds must be between 0 and {MAX_PROFILE_SECONDS}")
+    if not 1 <= interval_ms <= 1000:
+        raise HTTPException(status_code=400, detail="interval_ms must be between 1 and 1000")
+    if format not in ("collapsed", "json"):
+        raise HTTPException(status_code=400, detail="format must be 'collapsed' or 'json'")
+    
+    try:
+        report = await profile(seconds, interval=interval_ms / 1000)
+    except ProfilerBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    
+    if format == "json":
+        return report
+    lag = report["loop_lag"]
+    headers = {
+        "Content-Disposition": f'attachment; filename="profile-{os.getpid()}-{int(time.time())}.folded"',
+        "X-Profile-Samples": str(report["samples"]),
+    }
+    for key in ("p50_ms", "p99_ms", "max_ms", "blocked_ms"):
+        if key in lag:
+            headers[f"X-Loop-Lag-{key.replace('_ms', '').title()}-Ms"] = str(lag[key])
+    return PlainTextResponse(report["collapsed"], headers=headers)
+
+if PROFILER_ENABLED:
+    app.add_api_route("/api/admin/profile", profile_worker, methods=["GET"], include_in_schema=False)
 
 if __name__ == "__main__":
     import uvicorn
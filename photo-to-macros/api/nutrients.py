@@ -0,0 +1,329 @@
+import csv
+import os
+import re
+from functools import lru_cache
+
+import numpy as np
+
+# Fixed nutrient layout shared by every vector and matrix in this module.
+# Amounts are per 100 g unless a vector has been scaled to a portion.
+# The third field is the matching column in data/usda_food.csv (calories are
+# not in that file and are derived with Atwater factors on load).
+NUTRIENTS = (
+    ("calories", "kcal", None),
+    ("protein", "g", "Data.Protein"),
+    ("carbs", "g", "Data.Carbohydrate"),
+    ("fat", "g", "Data.Fat.Total Lipid"),
+    ("fiber", "g", "Data.Fiber"),
+    ("sugar", "g", "Data.Sugar Total"),
+    ("water", "g", "Data.Water"),
+    ("saturated_fat", "g", "Data.Fat.Saturated Fat"),
+    ("monounsaturated_fat", "g", "Data.Fat.Monosaturated Fat"),
+    ("polyunsaturated_fat", "g", "Data.Fat.Polysaturated Fat"),
+    ("cholesterol", "mg", "Data.Cholesterol"),
+    ("choline", "mg", "Data.Choline"),
+    ("alpha_carotene", "mcg", "Data.Alpha Carotene"),
+    ("beta_carotene", "mcg", "Data.Beta Carotene"),
+    ("beta_cryptoxanthin", "mcg", "Data.Beta Cryptoxanthin"),
+    ("lutein_zeaxanthin", "mcg", "Data.Lutein and Zeaxanthin"),
+    ("lycopene", "mcg", "Data.Lycopene"),
+    ("retinol", "mcg", "Data.Retinol"),
+    ("niacin", "mg", "Data.Niacin"),
+    ("riboflavin", "mg", "Data.Riboflavin"),
+    ("thiamin", "mg", "Data.Thiamin"),
+    ("selenium", "mcg", "Data.Selenium"),
+    ("calcium", "mg", "Data.Major Minerals.Calcium"),
+    ("copper", "mg", "Data.Major Minerals.Copper"),
+    ("iron", "mg", "Data.Major Minerals.Iron"),
+    ("magnesium", "mg", "Data.Major Minerals.Magnesium"),
+    ("phosphorus", "mg", "Data.Major Minerals.Phosphorus"),
+    ("potassium", "mg", "Data.Major Minerals.Potassium"),
+    ("sodium", "mg", "Data.Major Minerals.Sodium"),
+    ("zinc", "mg", "Data.Major Minerals.Zinc"),
+    ("vitamin_a_rae", "mcg", "Data.Vitamins.Vitamin A - RAE"),
+    ("vitamin_b12", "mcg", "Data.Vitamins.Vitamin B12"),
+    ("vitamin_b6", "mg", "Data.Vitamins.Vitamin B6"),
+    ("vitamin_c", "mg", "Data.Vitamins.Vitamin C"),
+    ("vitamin_e", "mg", "Data.Vitamins.Vitamin E"),
+    ("vitamin_k", "mcg", "Data.Vitamins.Vitamin K"),
+)
+
+NUTRIENT_KEYS = tuple(key for key, _, _ in NUTRIENTS)
+NUTRIENT_UNITS = {key: unit for key, unit, _ in NUTRIENTS}
+NUTRIENT_INDEX = {key: i for i, key in enumerate(NUTRIENT_KEYS)}
+MACRO_KEYS = ("calories", "protein", "carbs", "fat")
+
+# kcal per gram, laid out like a nutrient vector so energy is a dot product
+ATWATER_FACTORS = np.zeros(len(NUTRIENTS))
+ATWATER_FACTORS[NUTRIENT_INDEX["protein"]] = 4
+ATWATER_FACTORS[NUTRIENT_INDEX["carbs"]] = 4
+ATWATER_FACTORS[NUTRIENT_INDEX["fat"]] = 9
+
+# Portion units understood by NutrientVector.scale, in grams
+GRAMS_PER_UNIT = {
+    "mg": 0.001,
+    "g": 1.0,
+    "kg": 1000.0,
+    "oz": 28.349523125,
+    "lb": 453.59237,
+}
+
+USDA_TABLE_PATH = os.path.join(os.path.dirname(__file__), "..", "data", "usda_food.csv")
+
+
+class NutrientVector:
+    """
+    Amounts of every nutrient in NUTRIENTS, stored as one float array.
+
+    Vectors add, subtract and multiply by scalars element-wise, so totals and
+    portion scaling cover all nutrients at once instead of key by key.
+    """
+
+    __slots__ = ("values",)
+
+    def __init__(self, values=None):
+        if values is None:
+            values = np.zeros(len(NUTRIENTS))
+        values = np.asarray(values, dtype=float)
+        if values.shape != (len(NUTRIENTS),):
+            raise ValueError(f"Expected {len(NUTRIENTS)} nutrient values, got shape {values.shape}")
+        self.values = values
+
+    @classmethod
+    def from_dict(cls, mapping):
+        """Build a vector from a dict such as {"calories": 250, "protein": 15}; unknown and non-numeric entries are ignored."""
+        return cls(_row(mapping))
+
+    def to_dict(self, keys=MACRO_KEYS, ndigits=2):
+        """Return the selected nutrients as a dict, rounded to `ndigits` (None for no rounding)."""
+        return {
+            key: float(self.values[NUTRIENT_INDEX[key]]) if ndigits is None
+            else round(float(self.values[NUTRIENT_INDEX[key]]), ndigits)
+            for key in keys
+        }
+
+    def __getitem__(self, key):
+        return float(self.values[NUTRIENT_INDEX[key]])
+
+    def __add__(self, other):
+        if isinstance(other, NutrientVector):
+            return NutrientVector(self.values + other.values)
+        if other == 0:  # lets sum() start from its default 0
+            return self
+        return NotImplemented
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        if isinstance(other, NutrientVector):
+            return NutrientVector(self.values - other.values)
+        return NotImplemented
+
+    def __mul__(self, factor):
+        if isinstance(factor, (int, float)):
+            return NutrientVector(self.values * factor)
+        return NotImplemented
+
+    __rmul__ = __mul__
+
+    def __repr__(self):
+        return f"NutrientVector({self.to_dict()})"
+
+    def scale(self, amount, unit="g"):
+        """
+        Scale per-100 g amounts to a portion.
+
+        Args:
+            amount: Portion size
+            unit: Unit of `amount`, one of GRAMS_PER_UNIT
+
+        Returns:
+            A new NutrientVector for the portion
+        """
+        try:
+            grams = amount * GRAMS_PER_UNIT[unit]
+        except KeyError:
+            raise ValueError(f"Unknown portion unit {unit!r}, expected one of {sorted(GRAMS_PER_UNIT)}")
+        return NutrientVector(self.values * (grams / 100.0))
+
+    def atwater_calories(self):
+        """Calories implied by protein, carbs and fat."""
+        return float(self.values @ ATWATER_FACTORS)
+
+    def calorie_shares(self):
+        """Percentage of calories from protein, carbs and fat, or None if there are no calories."""
+        calories = self.values[NUTRIENT_INDEX["calories"]]
+        if calories <= 0:
+            return None
+        shares = self.values * ATWATER_FACTORS / calories * 100
+        return {key: float(shares[NUTRIENT_INDEX[key]]) for key in ("protein", "carbs", "fat")}
+
+    def is_energy_consistent(self, tolerance=0.2):
+        """True when stated calories are within `tolerance` (relative) of the Atwater estimate."""
+        return bool(energy_consistent(self.values, tolerance))
+
+
+def _row(mapping):
+    """Lay out the numeric nutrient entries of a dict as a list in NUTRIENTS order."""
+    row = [0.0] * len(NUTRIENTS)
+    for key, value in mapping.items():
+        index = NUTRIENT_INDEX.get(key)
+        if index is not None and isinstance(value, (int, float)) and not isinstance(value, bool):
+            row[index] = value
+    return row
+
+
+def stack(items):
+    """Stack NutrientVectors or nutrient dicts into an (n, len(NUTRIENTS)) matrix."""
+    rows = [item.values if isinstance(item, NutrientVector) else _row(item) for item in items]
+    if not rows:
+        return np.zeros((0, len(NUTRIENTS)))
+    return np.array(rows, dtype=float)
+
+
+def total(items):
+    """Sum NutrientVectors or nutrient dicts into a single NutrientVector."""
+    return NutrientVector(stack(items).sum(axis=0))
+
+
+def total_macros(components):
+    """
+    Total the macros of a list of component dicts, e.g. the "components" of an OpenAI estimate.
+
+    Adds the four macro keys directly: for the few components of one estimate
+    that is several times cheaper than building a matrix (use total() for
+    full nutrient vectors or many rows).
+    """
+    totals = dict.fromkeys(MACRO_KEYS, 0.0)
+    for component in components:
+        for key in MACRO_KEYS:
+            value = component.get(key)
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                totals[key] += value
+    return {key: round(value, 2) for key, value in totals.items()}
+
+
+def scale_macros(macros, factor):
+    """
+    Multiply the nutrient entries of a macros dict by `factor`.
+
+    Entries that are not nutrients (such as "source" or "quantity") are kept as is.
+    """
+    vector = NutrientVector.from_dict(macros) * factor
+    scaled = dict(macros)
+    for key, value in macros.items():
+        if key in NUTRIENT_INDEX and isinstance(value, (int, float)) and not isinstance(value, bool):
+            scaled[key] = round(vector[key], 2)
+    return scaled
+
+
+def energy_consistent(matrix, tolerance=0.2):
+    """
+    Check stated calories against the Atwater estimate for a vector or every row of a matrix.
+
+    Rows without any energy at all count as consistent.
+    """
+    matrix = np.asarray(matrix, dtype=float)
+    stated = matrix[..., NUTRIENT_INDEX["calories"]]
+    estimated = matrix @ ATWATER_FACTORS
+    scale = np.maximum(np.maximum(stated, estimated), 1e-9)
+    return np.abs(stated - estimated) / scale <= tolerance
+
+
+def rollup(matrix, timestamps, period="day"):
+    """
+    Sum meal vectors into daily or weekly totals with a single reduction.
+
+    Args:
+        matrix: An (n, len(NUTRIENTS)) array, one row per meal (see stack)
+        timestamps: n dates, datetimes or ISO date strings, one per meal
+        period: "day" or "week" (ISO weeks, starting on Monday)
+
+    Returns:
+        A tuple (periods, totals) where periods is a sorted datetime64[D]
+        array of day or week-start dates and totals the matching rows
+    """
+    matrix = np.asarray(matrix, dtype=float)
+    days = np.asarray(timestamps, dtype="datetime64[D]")
+    if period == "week":
+        # 1970-01-01 was a Thursday, three days after a Monday
+        days = days - (days.astype(np.int64) + 3) % 7
+    elif period != "day":
+        raise ValueError(f"Unknown rollup period {period!r}, expected 'day' or 'week'")
+    if len(days) == 0:
+        return days, np.zeros((0, len(NUTRIENTS)))
+
+    order = np.argsort(days, kind="stable")
+    sorted_days = days[order]
+    starts = np.flatnonzero(np.r_[True, sorted_days[1:] != sorted_days[:-1]])
+    return sorted_days[starts], np.add.reduceat(matrix[order], starts, axis=0)
+
+
+@lru_cache(maxsize=1)
+def load_usda_table(path=USDA_TABLE_PATH):
+    """
+    Load the bundled USDA table into the nutrient layout.
+
+    Returns:
+        A tuple (descriptions, matrix) with one per-100 g row per food
+    """
+    with open(path, encoding="utf-16", newline="") as f:
+        reader = csv.reader(f, delimiter="\t")
+        header = next(reader)
+        columns = [(NUTRIENT_INDEX[key], header.index(column)) for key, _, column in NUTRIENTS if column]
+        descriptions = []
+        rows = []
+        for record in reader:
+            if len(record) < len(header):
+                continue
+            row = np.zeros(len(NUTRIENTS))
+            for index, column in columns:
+                try:
+                    row[index] = float(record[column])
+                except ValueError:
+                    pass
+            descriptions.append(record[header.index("Description")])
+            rows.append(row)
+    matrix = np.vstack(rows) if rows else np.zeros((0, len(NUTRIENTS)))
+    matrix[:, NUTRIENT_INDEX["calories"]] = matrix @ ATWATER_FACTORS
+    return descriptions, matrix
+
+
+def find_usda_food(query):
+    """
+    Find the food in the bundled USDA table that best matches `query`.
+
+    Descriptions are ranked by where the query appears as whole words: the
+    leading part ("Butter, stick" for "butter") first, then within the leading
+    part ("Peanut butter"), then anywhere ("Toast, with butter"). Plain
+    substring matches ("Buttermilk") come last; ties keep table order.
+
+    Returns:
+        A tuple (description, NutrientVector per 100 g) or None if nothing matches
+    """
+    query = " ".join(query.lower().split())
+    if not query:
+        return None
+    descriptions, matrix = load_usda_table()
+    word = re.compile(rf"\b{re.escape(query)}\b")
+    best = None
+    for i, description in enumerate(descriptions):
+        text = description.lower()
+        if query not in text:
+            continue
+        lead = text.split(",", 1)[0].strip()
+        if lead == query:
+            rank = 0
+        elif word.search(lead):
+            rank = 1
+        elif word.search(text):
+            rank = 2
+        else:
+            rank = 3
+        if best is None or rank < best[0]:
+            best = (rank, i)
+            if rank == 0:
+                break
+    if best is None:
+        return None
+    return descriptions[best[1]], NutrientVector(matrix[best[1]])
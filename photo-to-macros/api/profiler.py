@@ -0,0 +1,171 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+API_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Leaf frame added to event-loop samples taken while the loop was blocked
+BLOCKED_FRAME = "[loop blocked]"
+
+# Only one profile may run per worker at a time
+_profile_lock = threading.Lock()
+
+
+class ProfilerBusy(Exception):
+    """Raised when a profile is requested while another one is running."""
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    path = code.co_filename
+    return f"{code.co_name} ({os.path.basename(os.path.dirname(path))}/{os.path.basename(path)})"
+
+
+class LoopLagMonitor:
+    """
+    Measure event-loop lag by sleeping for `tick` seconds and timing how late each wake-up is.
+
+    `last_tick` is read by the StackSampler thread: when it falls far behind,
+    the loop is stuck in synchronous code.
+    """
+
+    def __init__(self, tick):
+        self.tick = tick
+        self.lags = []
+        self.last_tick = time.perf_counter()
+        self._stopped = False
+
+    async def run(self):
+        self.last_tick = time.perf_counter()
+        while not self._stopped:
+            expected = time.perf_counter() + self.tick
+            await asyncio.sleep(self.tick)
+            now = time.perf_counter()
+            self.lags.append(max(now - expected, 0.0))
+            self.last_tick = now
+
+    def stop(self):
+        self._stopped = True
+
+    def summary(self, blocked_threshold):
+        lags = sorted(self.lags)
+        if not lags:
+            return {"ticks": 0}
+
+        def percentile(p):
+            return lags[min(int(len(lags) * p), len(lags) - 1)] * 1000
+
+        return {
+            "ticks": len(lags),
+            "mean_ms": round(sum(lags) / len(lags) * 1000, 2),
+            "p50_ms": round(percentile(0.50), 2),
+            "p99_ms": round(percentile(0.99), 2),
+            "max_ms": round(lags[-1] * 1000, 2),
+            "blocked_ms": round(sum(lag for lag in lags if lag > blocked_threshold) * 1000, 1),
+        }
+
+
+class StackSampler(threading.Thread):
+    """
+    Sample the Python stacks of every thread at a fixed interval.
+
+    Stacks are aggregated in collapsed form (root first, frames joined by ";")
+    so the output can be fed to flamegraph.pl or speedscope directly.
+    """
+
+    def __init__(self, interval, loop_thread_id, monitor, blocked_threshold):
+        super().__init__(name="stack-sampler", daemon=True)
+        self.interval = interval
+        self.loop_thread_id = loop_thread_id
+        self.monitor = monitor
+        self.blocked_threshold = blocked_threshold
+        self.stacks = Counter()
+        self.blocked_by = Counter()
+        self.samples = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        own_id = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            now = time.perf_counter()
+            loop_blocked = now - self.monitor.last_tick > self.monitor.tick + self.blocked_threshold
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                frames = []
+                api_frame = None
+                while frame is not None:
+                    frames.append(_frame_label(frame))
+                    if api_frame is None and frame.f_code.co_filename.startswith(API_DIR):
+                        api_frame = frame
+                    frame = frame.f_back
+                thread_name = names.get(thread_id, str(thread_id))
+                if thread_id == self.loop_thread_id:
+                    thread_name = "event-loop"
+                    if loop_blocked:
+                        # Mark the sample with a leaf frame so the root stays the
+                        # same and blocked stacks merge with the rest in a flamegraph
+                        frames.insert(0, BLOCKED_FRAME)
+                        # Charge the blocked time to the innermost call site in our own code
+                        site = "unknown"
+                        if api_frame is not None:
+                            site = f"{os.path.basename(api_frame.f_code.co_filename)}:{api_frame.f_code.co_name}:{api_frame.f_lineno}"
+                        self.blocked_by[site] += 1
+                frames.append(thread_name)
+                self.stacks[";".join(reversed(frames))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def collapsed(self):
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+async def profile(seconds, interval=0.01, blocked_threshold=0.02):
+    """
+    Profile the running worker for `seconds` while it keeps serving requests.
+
+    Must be awaited on the event loop being profiled.
+
+    Args:
+        seconds: How long to sample for
+        interval: Seconds between stack samples and loop-lag ticks
+        blocked_threshold: Loop lag, in seconds, above which the loop counts as blocked
+
+    Returns:
+        A dict with the collapsed stacks ("collapsed"), the number of samples,
+        an event-loop lag summary and the milliseconds the loop spent blocked
+        per call site in the api package ("blocked_by")
+    """
+    if not _profile_lock.acquire(blocking=False):
+        raise ProfilerBusy("A profile is already running on this worker")
+    try:
+        monitor = LoopLagMonitor(interval)
+        sampler = StackSampler(interval, threading.get_ident(), monitor, blocked_threshold)
+        monitor_task = asyncio.create_task(monitor.run())
+        sampler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            sampler.stop()
+            monitor.stop()
+            await monitor_task
+        return {
+            "seconds": seconds,
+            "interval_ms": interval * 1000,
+            "samples": sampler.samples,
+            "loop_lag": monitor.summary(blocked_threshold),
+            "blocked_by": {
+                site: round(count * interval * 1000, 1)
+                for site, count in sampler.blocked_by.most_common()
+            },
+            "collapsed": sampler.collapsed(),
+        }
+    finally:
+        _profile_lock.release()
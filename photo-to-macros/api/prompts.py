@@ -1,2 +1,44 @@
-def gpt_blurb(label, macros):
-    return f"{label.capitalize()} is estimated to have {macros.get('calories', '?')} calories and {macros.get('protein', '?')}g protein. Great choice!"
+def gpt_blurb(label, macros):
+    return f"{label.capitalize()} is estimated to have {macros.get('calories', '?')} calories and {macros.get('protein', '?')}g protein. Great choice!"
+
+
+# Compact, whitespace-minimal prompt for get_macros_from_openai. The reply
+# format is enforced by the strict JSON schema in
+# api.schemas.MACRO_RESPONSE_FORMAT; the prompt only says what its one-letter
+# keys mean. The total is computed on our side.
+MACRO_PROMPT_TEMPLATE = (
+    "Photo: {label}. Each food item in the portion shown: n name, k kcal, p/c/f protein/carbs/fat g."
+)
+
+# Split once at import so building a prompt is a plain concatenation
+_MACRO_PROMPT_PREFIX, _MACRO_PROMPT_SUFFIX = MACRO_PROMPT_TEMPLATE.format(label="\0").split("\0")
+
+
+def macro_prompt(label):
+    return _MACRO_PROMPT_PREFIX + label + _MACRO_PROMPT_SUFFIX
+
+
+# One call per image: every detected label and Vision candidate goes in as a
+# hint, and the model returns one deduplicated item list in the same format.
+CONSOLIDATED_PROMPT_TEMPLATE = (
+    "Meal photo. Vision hints (label confidence%): {hints}. Hints may overlap or be wrong. "
+    "Each distinct food item in the portion shown, once: n name, k kcal, p/c/f protein/carbs/fat g."
+)
+_CONSOLIDATED_PROMPT_PREFIX, _CONSOLIDATED_PROMPT_SUFFIX = CONSOLIDATED_PROMPT_TEMPLATE.format(hints="\0").split("\0")
+
+# Hints beyond this add tokens without helping the estimate
+MAX_PROMPT_HINTS = 10
+
+
+def consolidated_prompt(food_labels, candidates):
+    confidence = {c["label"]: c["confidence"] for c in candidates}
+    hints = []
+    seen = set()
+    for label in list(food_labels) + [c["label"] for c in candidates]:
+        if label in seen:
+            continue
+        seen.add(label)
+        hints.append(f"{label} {confidence[label]:g}" if label in confidence else label)
+        if len(hints) == MAX_PROMPT_HINTS:
+            break
+    return _CONSOLIDATED_PROMPT_PREFIX + "; ".join(hints) + _CONSOLIDATED_PROMPT_SUFFIX
@@ -0,0 +1,101 @@
+from typing import List
+
+from pydantic import BaseModel, ConfigDict, Field
+from typing_extensions import Annotated
+
+# Nutrient amounts the model may return; negative values are rejected
+Amount = Annotated[float, Field(ge=0)]
+
+
+class MacroItem(BaseModel):
+    """
+    One food item of a MacroEstimate: calories in kcal, the rest in grams.
+
+    The model sees the one-letter aliases (here and for MacroEstimate.items),
+    which keep both the response schema and the reply short; api.prompts
+    explains them.
+    """
+
+    # strict: "450" is rejected rather than coerced (ints are still accepted as floats)
+    model_config = ConfigDict(strict=True, extra="forbid", frozen=True)
+
+    name: str = Field(alias="n")
+    kcal: Amount = Field(alias="k")
+    protein: Amount = Field(alias="p")
+    carbs: Amount = Field(alias="c")
+    fat: Amount = Field(alias="f")
+
+
+class MacroEstimate(BaseModel):
+    """
+    Model output for the prompts in api.prompts, requested with MACRO_RESPONSE_FORMAT.
+
+    Parse with MacroEstimate.model_validate_json(content), which validates
+    straight from the JSON string using pydantic-core's parser.
+    """
+
+    model_config = ConfigDict(strict=True, extra="forbid", frozen=True)
+
+    items: List[MacroItem] = Field(alias="i", min_length=1)
+
+    def components(self):
+        """Return the items as component dicts with calories, protein, carbs and fat."""
+        return [
+            {"name": item.name, "calories": item.kcal, "protein": item.protein, "carbs": item.carbs, "fat": item.fat}
+            for item in self.items
+        ]
+
+    def total(self):
+        """Sum calories, protein, carbs and fat over the items, like api.nutrients.total_macros."""
+        items = self.items
+        return {
+            "calories": round(sum(item.kcal for item in items), 2),
+            "protein": round(sum(item.protein for item in items), 2),
+            "carbs": round(sum(item.carbs for item in items), 2),
+            "fat": round(sum(item.fat for item in items), 2),
+        }
+
+
+# Schema keywords that only constrain values; pydantic checks them on our side,
+# so sending them would just add prompt tokens
+_VALIDATION_ONLY_KEYWORDS = {
+    "title", "description", "default",
+    "minimum", "maximum", "exclusiveMinimum", "exclusiveMaximum",
+    "minItems", "maxItems", "minLength", "maxLength",
+}
+
+
+def strict_json_schema(model):
+    """
+    Smallest JSON schema of a pydantic model that OpenAI strict structured outputs accept.
+
+    References are inlined, every object gets all of its properties required
+    and no additional properties, and validation-only keywords are dropped.
+    """
+    schema = model.model_json_schema(by_alias=True)
+    definitions = schema.pop("$defs", {})
+
+    def clean(node):
+        if isinstance(node, list):
+            return [clean(value) for value in node]
+        if not isinstance(node, dict):
+            return node
+        if "$ref" in node:
+            return clean(definitions[node["$ref"].rsplit("/", 1)[-1]])
+        node = {
+            key: {name: clean(prop) for name, prop in value.items()} if key == "properties" else clean(value)
+            for key, value in node.items() if key not in _VALIDATION_ONLY_KEYWORDS
+        }
+        if node.get("type") == "object":
+            node["required"] = list(node.get("properties", {}))
+            node["additionalProperties"] = False
+        return node
+
+    return clean(schema)
+
+
+# response_format for chat completions: the API constrains the reply to MacroEstimate
+MACRO_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "macros", "strict": True, "schema": strict_json_schema(MacroEstimate)},
+}
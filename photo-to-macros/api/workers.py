@@ -0,0 +1,243 @@
+import asyncio
+import base64
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+from api.imaging import DEFAULT_MAX_SIDE, prepare_image
+
+# Payloads smaller than this are base64-encoded inline; shipping them to a
+# worker would cost more than the encoding itself
+B64_OFFLOAD_THRESHOLD = 256 * 1024
+
+
+def available_cpus():
+    """Number of CPUs this process may run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+# The functions below run inside worker processes. Image bytes come in and go
+# out through shared memory blocks owned (and unlinked) by the parent, so only
+# block names, lengths and small metadata are pickled. Each returns
+# (result, seconds spent).
+
+def _attach(name):
+    return shared_memory.SharedMemory(name=name)
+
+
+def _warm_up():
+    return None, 0.0
+
+
+def _prepare_task(in_name, size, out_name, capacity, max_side):
+    start = time.perf_counter()
+    source = _attach(in_name)
+    target = _attach(out_name)
+    try:
+        prepared = prepare_image(bytes(source.buf[:size]), max_side)
+        image = prepared.pop("image")
+        if len(image) > capacity:
+            raise ValueError(f"Prepared image is {len(image)} bytes, more than the {capacity} reserved for it")
+        target.buf[:len(image)] = image
+        prepared["size"] = len(image)
+    finally:
+        source.close()
+        target.close()
+    return prepared, time.perf_counter() - start
+
+
+def _prepared_capacity(max_side):
+    """Upper bound on the JPEG prepare_image produces: more than the raw RGB pixels, plus headers."""
+    return max_side * max_side * 3 + 64 * 1024
+
+
+def _b64encode_task(in_name, size, out_name):
+    start = time.perf_counter()
+    source = _attach(in_name)
+    target = _attach(out_name)
+    try:
+        encoded = base64.b64encode(source.buf[:size])
+        target.buf[:len(encoded)] = encoded
+    finally:
+        source.close()
+        target.close()
+    return len(encoded), time.perf_counter() - start
+
+
+class _Shared:
+    """A shared memory block holding `data` (or `size` empty bytes), unlinked on exit."""
+
+    def __init__(self, data=None, size=None):
+        size = len(data) if data is not None else size
+        self.size = size
+        self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        if data is not None:
+            self.shm.buf[:size] = data
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shm.close()
+        self.shm.unlink()
+
+
+class StageStats:
+    """Task counts and timings for one kind of CPU work."""
+
+    def __init__(self):
+        self.count = 0
+        self.failed = 0
+        self.total_run = 0.0
+        self.total_wait = 0.0
+        self.max_run = 0.0
+
+    def record(self, run_time, wall_time):
+        self.count += 1
+        self.total_run += run_time
+        self.total_wait += max(wall_time - run_time, 0.0)
+        self.max_run = max(self.max_run, run_time)
+
+    def as_dict(self):
+        done = self.count or 1
+        return {
+            "count": self.count,
+            "failed": self.failed,
+            "mean_run_ms": round(self.total_run / done * 1000, 2),
+            "mean_wait_ms": round(self.total_wait / done * 1000, 2),
+            "max_run_ms": round(self.max_run * 1000, 2),
+        }
+
+
+class CPUWorkerPool:
+    """
+    Process pool for CPU-bound work on uploads, so it doesn't stall the event loop.
+
+    Call start() and shutdown() from the app lifespan. Until the pool is
+    started every stage runs inline in the calling process, which keeps the
+    helpers usable from scripts and the batch CLI.
+
+    If a worker dies (killed for memory, or crashing in a decoder), the
+    executor is broken for good: it is replaced with a fresh one and the
+    affected task is retried once.
+    """
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or available_cpus()
+        self._executor = None
+        self._pending = 0
+        self._stages = {}
+        self.restarts = 0
+        self.last_error = None
+
+    @property
+    def running(self):
+        return self._executor is not None
+
+    def _spawn(self):
+        # spawn rather than fork: the server process already runs threads
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        # Start every worker now instead of on the first requests
+        return [self._executor.submit(_warm_up) for _ in range(self.max_workers)]
+
+    def start(self):
+        """
+        Start the worker processes.
+
+        Returns:
+            concurrent.futures.Future objects that finish once each worker is up,
+            e.g. for asyncio.gather(*map(asyncio.wrap_future, futures))
+        """
+        if self._executor is not None:
+            return []
+        futures = self._spawn()
+        print(f"Started CPU worker pool with {self.max_workers} processes")
+        return futures
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    def _restart(self, broken, error):
+        """Replace a broken executor, unless another task already did (or the pool was shut down)."""
+        if self._executor is not broken:
+            return
+        broken.shutdown(wait=False, cancel_futures=True)
+        self.restarts += 1
+        self.last_error = repr(error)
+        print(f"CPU worker pool broken ({error!r}), restarting it")
+        self._spawn()
+
+    async def _submit(self, func, *args):
+        loop = asyncio.get_running_loop()
+        for attempt in range(2):
+            executor = self._executor
+            try:
+                return await loop.run_in_executor(executor, func, *args)
+            except BrokenProcessPool as e:
+                self._restart(executor, e)
+                if attempt or self._executor is None:
+                    raise
+
+    async def _run(self, stage, func, *args):
+        stats = self._stages.setdefault(stage, StageStats())
+        start = time.perf_counter()
+        self._pending += 1
+        try:
+            if self._executor is None:
+                result, run_time = func(*args)
+            else:
+                result, run_time = await self._submit(func, *args)
+        except Exception:
+            stats.failed += 1
+            raise
+        finally:
+            self._pending -= 1
+        stats.record(run_time, time.perf_counter() - start)
+        return result
+
+    async def prepare_image(self, image_bytes, max_side=DEFAULT_MAX_SIDE):
+        """Decode, orient, resize and perceptually hash an upload (see api.imaging.prepare_image)."""
+        capacity = _prepared_capacity(max_side)
+        with _Shared(image_bytes) as source, _Shared(size=capacity) as target:
+            prepared = await self._run(
+                "prepare_image", _prepare_task, source.shm.name, source.size, target.shm.name, capacity, max_side
+            )
+            prepared["image"] = bytes(target.shm.buf[:prepared.pop("size")])
+            return prepared
+
+    async def b64encode(self, data):
+        """Base64-encode bytes to a str, in a worker when the payload is large."""
+        if self._executor is None or len(data) < B64_OFFLOAD_THRESHOLD:
+            return base64.b64encode(data).decode("ascii")
+        with _Shared(data) as source, _Shared(size=4 * ((len(data) + 2) // 3)) as target:
+            length = await self._run("b64encode", _b64encode_task, source.shm.name, source.size, target.shm.name)
+            return bytes(target.shm.buf[:length]).decode("ascii")
+
+    def stats(self):
+        """Pool state, size, queue depth, restarts and per-stage timings (wait is time spent queued)."""
+        in_flight = min(self._pending, self.max_workers) if self.running else self._pending
+        if not self.running:
+            state = "stopped"
+        elif getattr(self._executor, "_broken", False):
+            state = "broken"  # replaced by the next task submitted
+        else:
+            state = "running"
+        return {
+            "running": state == "running",
+            "state": state,
+            "restarts": self.restarts,
+            "last_error": self.last_error,
+            "workers": self.max_workers if self.running else 0,
+            "in_flight": in_flight,
+            "queue_depth": self._pending - in_flight,
+            "stages": {stage: stats.as_dict() for stage, stats in self._stages.items()},
+        }
@@ -0,0 +1,149 @@
+"""
+Compare the original verbose prompt/parsing in get_macros_from_openai with the
+compact prompt, strict response schema and MacroEstimate parsing.
+
+Usage (from inside photo-to-macros/):
+    python -m benchmarks.prompt_parsing
+
+Token counts use tiktoken's o200k_base encoding (GPT-4.1) when tiktoken and
+the encoding are available. Otherwise they are a rough estimate of one token
+per 4 characters with whitespace runs collapsed, and are labelled as such.
+The "after" prompt includes the response schema, which is sent (and billed)
+as input alongside the prompt.
+"""
+import json
+import sys
+import timeit
+
+from pydantic import ValidationError
+
+from api.prompts import macro_prompt
+from api.schemas import MACRO_RESPONSE_FORMAT, MacroEstimate
+
+LABEL = "3 tacos"
+
+
+def legacy_prompt(food_label):
+    """The prompt as it was before the compact template."""
+    return f"""
+        This image contains {food_label}.
+
+        Identify the main food items and for EACH provide:
+        1. Name
+        2. Calories
+        3. Protein (g)
+        4. Carbs (g)
+        5. Fat (g)
+
+        Return ONLY a valid JSON object in this structure:
+        {{
+          "total": {{"calories": number, "protein": number, "carbs": number, "fat": number}},
+          "components": [
+            {{"name": "food1", "calories": number, "protein": number, "carbs": number, "fat": number}},
+            {{"name": "food2", "calories": number, "protein": number, "carbs": number, "fat": number}}
+          ]
+        }}
+        """
+
+
+# The same meal answered in each format, both serialized without whitespace
+LEGACY_RESPONSE = json.dumps({
+    "total": {"calories": 660, "protein": 36, "carbs": 70, "fat": 24},
+    "components": [
+        {"name": "Street Tacos (3 carne asada)", "calories": 450, "protein": 30, "carbs": 45, "fat": 20},
+        {"name": "Salsa (red, small portion)", "calories": 15, "protein": 0, "carbs": 3, "fat": 0},
+        {"name": "Lime Wedge & Garnish", "calories": 5, "protein": 0, "carbs": 1, "fat": 0},
+    ],
+}, separators=(",", ":"))
+COMPACT_RESPONSE = json.dumps({
+    "i": [
+        {"n": "Street Tacos (3 carne asada)", "k": 450, "p": 30, "c": 45, "f": 20},
+        {"n": "Salsa (red, small portion)", "k": 15, "p": 0, "c": 3, "f": 0},
+        {"n": "Lime Wedge & Garnish", "k": 5, "p": 0, "c": 1, "f": 0},
+    ],
+}, separators=(",", ":"))
+RESPONSE_SCHEMA = json.dumps(MACRO_RESPONSE_FORMAT["json_schema"], separators=(",", ":"))
+
+
+def legacy_parse(content, food_label=LABEL):
+    """The json.loads + dict-check parsing that get_macros_from_openai used to do."""
+    macros = json.loads(content)
+    if 'components' in macros and 'total' in macros:
+        macros['total'] = {
+            'calories': sum(comp.get('calories', 0) for comp in macros['components']),
+            'protein': sum(comp.get('protein', 0) for comp in macros['components']),
+            'carbs': sum(comp.get('carbs', 0) for comp in macros['components']),
+            'fat': sum(comp.get('fat', 0) for comp in macros['components'])
+        }
+        macros['source'] = 'openai'
+        return macros
+    required_fields = ['calories', 'protein', 'carbs', 'fat']
+    if all(field in macros for field in required_fields):
+        total = {field: macros[field] for field in required_fields}
+        return {'total': total, 'components': [{'name': food_label, **total}], 'source': 'openai'}
+    return None
+
+
+def legacy_parse_only(content):
+    """legacy_parse without the total recalculation."""
+    macros = json.loads(content)
+    return macros if 'components' in macros and 'total' in macros else None
+
+
+def compact_parse(content):
+    """The current parsing: schema validation straight from the JSON string."""
+    try:
+        estimate = MacroEstimate.model_validate_json(content)
+    except ValidationError:
+        return None
+    return {'total': estimate.total(), 'components': estimate.components(), 'source': 'openai'}
+
+
+def compact_parse_only(content):
+    """compact_parse without the total recalculation."""
+    return MacroEstimate.model_validate_json(content).components()
+
+
+def rough_token_count(text):
+    """About 4 characters per token; runs of whitespace mostly merge into one token."""
+    return round(len(" ".join(text.split())) / 4)
+
+
+def token_counter():
+    rough = "ROUGH ESTIMATE (chars/4, install tiktoken for real counts)"
+    try:
+        import tiktoken
+    except ImportError:
+        return rough, rough_token_count
+    try:
+        encoding = tiktoken.get_encoding("o200k_base")
+    except Exception:  # the encoding is downloaded on first use
+        return rough, rough_token_count
+    return "o200k_base", lambda text: len(encoding.encode(text))
+
+
+def time_us(func, *args, number=20000):
+    return min(timeit.repeat(lambda: func(*args), number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    assert legacy_parse(LEGACY_RESPONSE)['total'] == {'calories': 470, 'protein': 30, 'carbs': 49, 'fat': 20}
+    assert compact_parse(COMPACT_RESPONSE)['total'] == {'calories': 470.0, 'protein': 30.0, 'carbs': 49.0, 'fat': 20.0}
+
+    encoding, count = token_counter()
+    rows = [
+        ("prompt + schema tokens", count(legacy_prompt(LABEL)), count(macro_prompt(LABEL)) + count(RESPONSE_SCHEMA)),
+        ("response tokens", count(LEGACY_RESPONSE), count(COMPACT_RESPONSE)),
+        ("parse (us)", time_us(legacy_parse_only, LEGACY_RESPONSE), time_us(compact_parse_only, COMPACT_RESPONSE)),
+        ("parse + totals (us)", time_us(legacy_parse, LEGACY_RESPONSE), time_us(compact_parse, COMPACT_RESPONSE)),
+        ("build prompt (us)", time_us(legacy_prompt, LABEL), time_us(macro_prompt, LABEL)),
+    ]
+    print(f"Token counts: {encoding}")
+    print(f"{'':<24}{'before':>10}{'after':>10}")
+    for name, before, after in rows:
+        print(f"{name:<24}{before:>10.1f}{after:>10.1f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,6 +3,43 @@ import axios from 'axios';
 // Base URL for API requests - direct connection to the FastAPI server
 const API_URL = 'http://localhost:8000';
 
+/**
+ * Computes the SHA-256 of a file as a hex string, the key the backend stores results under
+ * 
+ * @param {File} file - The file to hash
+ * @returns {Promise<string|null>} - The hex digest, or null if Web Crypto is unavailable
+ */
+const hashFile = async (file) => {
+  if (!window.crypto || !window.crypto.subtle) {
+    return null;
+  }
+  const digest = await window.crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+  return Array.from(new Uint8Array(digest))
+    .map((byte) => byte.toString(16).padStart(2, '0'))
+    .join('');
+};
+
+/**
+ * Looks up a previous analysis of the same image so it doesn't have to be uploaded again
+ * 
+ * @param {File} imageFile - The image file to look up
+ * @returns {Promise<Object|null>} - The cached analysis results, or null on a miss
+ */
+const getCachedAnalysis = async (imageFile) => {
+  try {
+    const imageHash = await hashFile(imageFile);
+    if (!imageHash) {
+      return null;
+    }
+    // The browser revalidates with If-None-Match and reuses its copy on a 304
+    const response = await axios.get(`${API_URL}/api/results/${imageHash}`);
+    return response.data;
+  } catch (error) {
+    // 404 means the backend hasn't seen this image yet
+    return null;
+  }
+};
+
 /**
  * Analyzes a food image by sending it to the backend
  * 
@@ -11,6 +48,13 @@ const API_URL = 'http://localhost:8000';
  */
 export const analyzeFoodImage = async (imageFile) => {
   try {
+    // Skip the upload entirely if this exact photo was analyzed before
+    const cached = await getCachedAnalysis(imageFile);
+    if (cached) {
+      console.log('Cached API response:', cached); // For debugging
+      return cached;
+    }
+    
     // Create a FormData object to send the image
     const formData = new FormData();
     formData.append('file', imageFile);
@@ -0,0 +1,100 @@
+import asyncio
+
+import pytest
+
+from api import main
+from api.main import (
+    MACRO_MAX_TOKENS,
+    fallback_macros,
+    get_consolidated_macros,
+    match_label,
+)
+
+
+def component(name, calories, protein=0, carbs=0, fat=0):
+    return {"name": name, "calories": calories, "protein": protein, "carbs": carbs, "fat": fat}
+
+
+@pytest.fixture
+def model_reply(monkeypatch):
+    """Replace the OpenAI call with a canned estimate and record what it was asked."""
+    calls = []
+
+    def use(macros):
+        async def fake_request(image_bytes, prompt, food_label, max_tokens=MACRO_MAX_TOKENS):
+            calls.append({"prompt": prompt, "food_label": food_label, "max_tokens": max_tokens})
+            return macros
+
+        monkeypatch.setattr(main, "request_macro_estimate", fake_request)
+        return calls
+
+    return use
+
+
+def consolidate(food_labels, candidates=()):
+    return asyncio.run(get_consolidated_macros(b"image", food_labels, list(candidates)))
+
+
+def test_match_label_by_word_overlap():
+    labels = ["3 tacos", "salsa", "lime"]
+    assert match_label("Street tacos", labels) == "3 tacos"
+    assert match_label("Red salsa", labels) == "salsa"
+    assert match_label("Lime wedge", labels) == "lime"
+
+
+def test_match_label_ignores_size_words():
+    assert match_label("small fries", ["burger", "fries"]) == "fries"
+    assert match_label("large side of fries", ["burger", "fries"]) == "fries"
+
+
+def test_match_label_falls_back_to_first_label():
+    assert match_label("Rice", ["3 tacos", "salsa"]) == "3 tacos"
+    # Equal overlap goes to the earlier label
+    assert match_label("chicken salad", ["chicken", "salad"]) == "chicken"
+
+
+def test_consolidated_keeps_every_item(model_reply):
+    items = [
+        component("Beef taco", 200, 10, 20, 9),
+        component("Beef taco", 200, 10, 20, 9),
+        component("small fries", 230, 3, 29, 11),
+        component("large fries", 370, 5, 48, 17),
+    ]
+    model_reply({"total": {}, "components": items, "source": "openai"})
+    results = consolidate(["beef taco", "fries"])
+
+    assert [r["label"] for r in results] == ["beef taco", "fries"]
+    assert [len(r["macros"]["components"]) for r in results] == [2, 2]
+    assert sum(r["macros"]["total"]["calories"] for r in results) == 1000
+    assert results[0]["macros"]["total"] == {"calories": 400, "protein": 20, "carbs": 40, "fat": 18}
+    assert all(r["macros"]["source"] == "openai" for r in results)
+
+
+def test_consolidated_skips_labels_without_items(model_reply):
+    model_reply({"total": {}, "components": [component("Street tacos", 450)], "source": "openai"})
+    assert [r["label"] for r in consolidate(["3 tacos", "salsa"])] == ["3 tacos"]
+
+
+def test_consolidated_passes_fallback_through_unsplit(model_reply):
+    model_reply(fallback_macros("3 tacos, salsa", "generic_fallback"))
+    results = consolidate(["3 tacos", "salsa"])
+    assert len(results) == 1
+    assert results[0]["label"] == "3 tacos, salsa"
+    assert results[0]["macros"]["source"] == "generic_fallback"
+
+
+def test_consolidated_without_labels_or_estimate(model_reply):
+    calls = model_reply(None)
+    assert consolidate([]) == []
+    assert calls == []
+    assert consolidate(["taco"]) == []
+
+
+def test_consolidated_reply_budget_grows_with_hints(model_reply):
+    calls = model_reply(None)
+    consolidate(["taco"])
+    consolidate(["taco", "salsa", "lime"], [{"label": "rice", "confidence": 80.0}, {"label": "food", "confidence": 99.0}])
+    one_label, four_hints = (call["max_tokens"] for call in calls)
+    assert MACRO_MAX_TOKENS < one_label < four_hints
+    # Generic labels such as "food" are not hints and don't add to the budget
+    assert four_hints - MACRO_MAX_TOKENS == 4 * (one_label - MACRO_MAX_TOKENS)
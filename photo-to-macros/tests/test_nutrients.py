@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+from api.nutrients import (
+    NUTRIENT_INDEX,
+    NutrientVector,
+    energy_consistent,
+    find_usda_food,
+    rollup,
+    stack,
+    total_macros,
+)
+
+MEAL = {"calories": 250, "protein": 15, "carbs": 25, "fat": 10}
+
+
+def test_scale_converts_units_to_grams():
+    per_100g = NutrientVector.from_dict(MEAL)
+    assert per_100g.scale(200).to_dict() == {"calories": 500, "protein": 30, "carbs": 50, "fat": 20}
+    assert per_100g.scale(0.5, "kg").to_dict() == per_100g.scale(500).to_dict()
+    assert per_100g.scale(8, "oz").to_dict() == {"calories": 566.99, "protein": 34.02, "carbs": 56.7, "fat": 22.68}
+    assert per_100g.scale(1, "lb").to_dict() == per_100g.scale(16, "oz").to_dict()
+    assert per_100g.scale(100000, "mg").to_dict() == per_100g.to_dict()
+
+
+def test_scale_rejects_unknown_unit():
+    with pytest.raises(ValueError):
+        NutrientVector.from_dict(MEAL).scale(1, "cup")
+
+
+def test_rollup_by_day_sums_meals_on_the_same_date():
+    matrix = stack([MEAL, MEAL, MEAL])
+    days, totals = rollup(matrix, ["2026-10-20T19:00", "2026-10-19T08:00", "2026-10-20T08:00"])
+    assert [str(day) for day in days] == ["2026-10-19", "2026-10-20"]
+    assert totals[:, NUTRIENT_INDEX["calories"]].tolist() == [250, 500]
+
+
+def test_rollup_by_week_starts_on_monday():
+    # 2026-10-19 is a Monday: the following Sunday is the same ISO week, the next Monday is not
+    matrix = stack([MEAL] * 4)
+    weeks, totals = rollup(matrix, ["2026-10-19", "2026-10-25", "2026-10-26", "2026-10-18"], period="week")
+    assert [str(week) for week in weeks] == ["2026-10-12", "2026-10-19", "2026-10-26"]
+    assert totals[:, NUTRIENT_INDEX["calories"]].tolist() == [250, 500, 250]
+
+
+def test_rollup_week_crossing_new_year():
+    # 2026-01-01 is a Thursday in the ISO week that starts on Monday 2025-12-29
+    weeks, _ = rollup(stack([MEAL, MEAL]), ["2025-12-29", "2026-01-04"], period="week")
+    assert [str(week) for week in weeks] == ["2025-12-29"]
+
+
+def test_rollup_rejects_unknown_period():
+    with pytest.raises(ValueError):
+        rollup(stack([MEAL]), ["2026-10-19"], period="month")
+
+
+def test_energy_consistency_tolerance():
+    # Atwater estimate for MEAL: 15 * 4 + 25 * 4 + 10 * 9 = 250 kcal
+    assert NutrientVector.from_dict(MEAL).is_energy_consistent()
+    assert NutrientVector.from_dict({**MEAL, "calories": 300}).is_energy_consistent(tolerance=0.2)
+    assert not NutrientVector.from_dict({**MEAL, "calories": 320}).is_energy_consistent(tolerance=0.2)
+    assert not NutrientVector.from_dict({**MEAL, "calories": 300}).is_energy_consistent(tolerance=0.1)
+
+
+def test_energy_consistency_per_matrix_row():
+    matrix = stack([MEAL, {**MEAL, "calories": 900}, {}])
+    assert energy_consistent(matrix).tolist() == [True, False, True]
+    assert isinstance(energy_consistent(matrix), np.ndarray)
+
+
+def test_total_macros_skips_missing_and_non_numeric_values():
+    components = [{"name": "taco", **MEAL}, {"name": "salsa", "calories": 15, "carbs": 3, "fat": "n/a"}]
+    assert total_macros(components) == {"calories": 265, "protein": 15, "carbs": 28, "fat": 10}
+    assert total_macros([]) == {"calories": 0, "protein": 0, "carbs": 0, "fat": 0}
+
+
+def test_find_usda_food_prefers_whole_word_matches():
+    assert find_usda_food("butter")[0].startswith("Butter, ")
+    assert find_usda_food("Peanut  Butter")[0] == "Peanut butter"
+    assert find_usda_food("buttermilk")[0].startswith("Buttermilk")
+    assert find_usda_food("no such food") is None